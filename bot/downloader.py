@@ -1,18 +1,57 @@
 import asyncio
+import hashlib
+import heapq
 import os
 import tempfile
+import threading
 from typing import Any, Dict, List, Optional, Tuple
 
+import diskcache
 import yt_dlp
+from cachetools import TTLCache
+
+# Info dicts from the preview extraction, reused on download so each button
+# click does not trigger a second full metadata fetch.
+_info_cache: "TTLCache[str, Dict[str, Any]]" = TTLCache(maxsize=512, ttl=600)
+_info_cache_lock = threading.Lock()
+
+# Persistent second layer: survives bot restarts, so popular videos are not
+# re-extracted after every deploy. The default dir must stay outside the
+# vd_* namespace that the temp-dir sweeper in main.py deletes.
+_meta_cache = diskcache.Cache(
+    os.getenv("META_CACHE_DIR", os.path.join(tempfile.gettempdir(), "spddwnld-meta")))
+_META_TTL = 86400  # seconds
 
 
 class VideoInfo:
-    def __init__(self, title: str, webpage_url: str, thumbnail_url: Optional[str], format_rows: List[Tuple[str, str]]):
+    def __init__(self, title: str, webpage_url: str, thumbnail_url: Optional[str],
+                 format_rows: List[Tuple[int, str]], urlhash: str):
         self.title = title
         self.webpage_url = webpage_url
         self.thumbnail_url = thumbnail_url
-        # List of (selector, label) pairs for display as buttons
+        # List of (height, label) pairs for display as buttons; 0 means "best"
         self.format_rows = format_rows
+        # Short stable hash of the source URL, embedded in callback_data
+        self.urlhash = urlhash
+
+
+def url_hash(url: str) -> str:
+    # BLAKE2 is fast and native in CPython; 4 bytes keeps callback_data short
+    return hashlib.blake2b(url.encode(), digest_size=4).hexdigest()
+
+
+def lookup_url(urlhash: str) -> Optional[str]:
+    return _meta_cache.get(f"u:{urlhash}")
+
+
+def selector_for_height(height: int) -> str:
+    if height <= 0:
+        return "bv*+ba/best"
+    return _COMMON_SELECTORS.get(height) or _height_selector(height)
+
+
+def label_for_height(height: int) -> str:
+    return f"{height}p" if height > 0 else "Лучшее доступное"
 
 
 def _best_thumbnail(info: Dict[str, Any]) -> Optional[str]:
@@ -36,34 +75,41 @@ def _best_thumbnail(info: Dict[str, Any]) -> Optional[str]:
     return best
 
 
-def _collect_heights(info: Dict[str, Any]) -> List[int]:
-    heights: set[int] = set()
-    for f in info.get("formats", []):
-        if f.get("vcodec") and f.get("vcodec") != "none":
-            height = f.get("height")
-            if isinstance(height, int):
-                heights.add(height)
-    return sorted(heights, reverse=True)
+# Prefer a pre-muxed mp4 at or below the cap before falling back to a
+# merge — skips the ffmpeg invocation entirely when the site offers
+# progressive variants (YouTube/Vimeo usually do).
+def _height_selector(h: int) -> str:
+    return f"best[height<={h}][ext=mp4]/bv*[height<={h}]+ba/b[height<={h}]"
+
 
+# Most videos use the standard resolution ladder, so precompute those
+# selectors once instead of formatting the same strings per request.
+_COMMON_SELECTORS: Dict[int, str] = {
+    h: _height_selector(h) for h in (144, 240, 360, 480, 720, 1080, 1440, 2160, 4320)
+}
 
-def _build_format_rows(info: Dict[str, Any], limit: int = 10) -> List[Tuple[str, str]]:
-    heights = _collect_heights(info)
-    rows: List[Tuple[str, str]] = []
 
-    # Build selectors that prefer separate streams with merge, fallback to single best at that height
-    for h in heights[:limit]:
-        selector = f"bv*[height={h}]+ba/b[height={h}]"
-        label = f"{h}p"
-        rows.append((selector, label))
+def _build_format_rows(info: Dict[str, Any], limit: int = 10) -> List[Tuple[int, str]]:
+    # Single pass over the formats: dedupe heights of video-carrying streams,
+    # then take only the top `limit` (some sites return 50+ formats).
+    heights_seen: set[int] = set()
+    for f in info.get("formats", ()):
+        vcodec = f.get("vcodec")
+        height = f.get("height")
+        if vcodec and vcodec != "none" and isinstance(height, int):
+            heights_seen.add(height)
 
-    # Always include a generic best as a fallback
-    if "best" not in [s for s, _ in rows]:
-        rows.append(("bv*+ba/best", "Лучшее доступное"))
+    rows: List[Tuple[int, str]] = []
+    for h in heapq.nlargest(limit, heights_seen):
+        rows.append((h, label_for_height(h)))
+
+    # Always include a generic best as a fallback (height 0 sentinel)
+    rows.append((0, label_for_height(0)))
 
     return rows
 
 
-def _base_ydl_opts(temp_dir: str) -> Dict[str, Any]:
+def _common_ydl_opts(temp_dir: str) -> Dict[str, Any]:
     return {
         "noprogress": True,
         "quiet": True,
@@ -73,27 +119,123 @@ def _base_ydl_opts(temp_dir: str) -> Dict[str, Any]:
         "merge_output_format": "mp4",
         # Let yt-dlp use ffmpeg if needed
         "postprocessors": [],
+        # Shared cookie jar so consecutive extractions reuse sessions instead
+        # of renegotiating with the site every time (yt-dlp skips loading the
+        # file until it exists)
+        "cookiefile": os.getenv(
+            "COOKIE_FILE", os.path.join(tempfile.gettempdir(), "vd_cookies.txt")),
+        # Fail fast rather than hanging a worker thread on a stuck socket
+        "socket_timeout": 15,
+        "retries": 2,
+        "fragment_retries": 2,
     }
 
 
-def extract_video_info_sync(url: str) -> VideoInfo:
-    opts = _base_ydl_opts(tempfile.gettempdir())
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-        if info.get("_type") == "playlist":
-            # Take first entry if a playlist URL is provided
-            entries = info.get("entries") or []
-            if not entries:
-                raise RuntimeError("Плейлист пустой или не поддерживается")
-            info = entries[0]
-        title = info.get("title") or "Видео"
-        thumb = _best_thumbnail(info)
-        format_rows = _build_format_rows(info)
-        return VideoInfo(title=title, webpage_url=info.get("webpage_url") or url, thumbnail_url=thumb, format_rows=format_rows)
+def _base_ydl_opts(temp_dir: str) -> Dict[str, Any]:
+    # Preview path only: the buttons need just height/vcodec per format,
+    # so skip the extra manifest round-trips during extraction.
+    opts = _common_ydl_opts(temp_dir)
+    opts.update({
+        "youtube_include_dash_manifest": False,
+        "youtube_include_hls_manifest": False,
+        "extractor_args": {"youtube": {"skip": ["dash", "hls", "translated_subs"]}},
+        # Only the first entry is ever shown, so don't crawl whole playlists
+        "playlist_items": "1",
+        "playlistend": 1,
+    })
+    return opts
+
+
+def _download_ydl_opts(temp_dir: str) -> Dict[str, Any]:
+    # Download path keeps full format discovery so the selector can still
+    # pick the best DASH/HLS streams.
+    opts = _common_ydl_opts(temp_dir)
+    # Rank mp4/h264/aac first so the pre-muxed branch of the selector wins
+    # whenever the site offers it.
+    opts["format_sort"] = ["res", "ext:mp4:m4a", "codec:h264:aac"]
+    return opts
+
+
+# Constructing a YoutubeDL instance initialises every extractor; amortise that
+# by keeping one long-lived instance per worker thread for the preview path.
+# Downloads keep a fresh instance since their opts embed a per-call temp dir.
+_tl = threading.local()
+
+
+def _get_preview_ydl() -> yt_dlp.YoutubeDL:
+    ydl = getattr(_tl, "preview_ydl", None)
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL(_base_ydl_opts(tempfile.gettempdir()))
+        _tl.preview_ydl = ydl
+    return ydl
+
+
+def _fetch_info_dict(url: str) -> Dict[str, Any]:
+    ydl = _get_preview_ydl()
+    info = ydl.extract_info(url, download=False)
+    if info.get("_type") == "playlist":
+        # Take first entry if a playlist URL is provided
+        entries = info.get("entries") or []
+        if not entries:
+            raise RuntimeError("Плейлист пустой или не поддерживается")
+        info = entries[0]
+    # sanitize_info makes the dict picklable for the persistent cache
+    return ydl.sanitize_info(info)
+
+
+# Format fields needed to rebuild the quality buttons (and enough for a
+# best-effort replay); everything else is dead weight on disk.
+_SLIM_FORMAT_KEYS = ("format_id", "height", "vcodec", "acodec", "ext", "url")
+
+
+def _slim_info(info: Dict[str, Any]) -> Dict[str, Any]:
+    # Full info dicts carry formats/thumbnails/subtitles/heatmap — tens of KB
+    # that the preview never reads. Keep only what the bot actually uses.
+    slim = {k: info.get(k) for k in (
+        "id", "title", "ext", "extractor", "webpage_url", "webpage_url_basename")}
+    slim["thumbnail"] = _best_thumbnail(info)
+    slim["formats"] = [
+        {k: f.get(k) for k in _SLIM_FORMAT_KEYS if k in f}
+        for f in info.get("formats", ())
+    ]
+    return slim
+
+
+def _get_info_dict(url: str, refresh: bool = False) -> Dict[str, Any]:
+    if not refresh:
+        with _info_cache_lock:
+            info = _info_cache.get(url)
+        if info is not None:
+            return info
+        info = _meta_cache.get(url)
+        if info is not None:
+            # Slimmed copy from disk: enough for the preview, but deliberately
+            # not promoted to the in-memory cache used for download replay.
+            return info
+    info = _fetch_info_dict(url)
+    with _info_cache_lock:
+        _info_cache[url] = info
+    _meta_cache.set(url, _slim_info(info), expire=_META_TTL)
+    return info
+
+
+def extract_video_info_sync(url: str, refresh: bool = False) -> VideoInfo:
+    # refresh=True bypasses and overwrites both cache layers, e.g. for a dead
+    # thumbnail URL or a changed format ladder
+    info = _get_info_dict(url, refresh)
+    # Remember hash -> url so download callbacks survive bot restarts
+    urlhash = url_hash(url)
+    _meta_cache.set(f"u:{urlhash}", url, expire=_META_TTL)
+    title = info.get("title") or "Видео"
+    thumb = _best_thumbnail(info)
+    format_rows = _build_format_rows(info)
+    return VideoInfo(title=title, webpage_url=info.get("webpage_url") or url,
+                     thumbnail_url=thumb, format_rows=format_rows, urlhash=urlhash)
 
 
-async def extract_video_info(url: str) -> VideoInfo:
-    return await asyncio.to_thread(extract_video_info_sync, url)
+async def extract_video_info(url: str, refresh: bool = False) -> VideoInfo:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, extract_video_info_sync, url, refresh)
 
 
 def download_video_sync(url: str, format_selector: str) -> Tuple[str, str, str]:
@@ -101,12 +243,23 @@ def download_video_sync(url: str, format_selector: str) -> Tuple[str, str, str]:
     Download the video with the given selector. Returns (filepath, filename, ext).
     """
     temp_dir = tempfile.mkdtemp(prefix="vd_")
-    opts = _base_ydl_opts(temp_dir)
+    opts = _download_ydl_opts(temp_dir)
     opts.update({
         "format": format_selector,
+        # Keep the metadata next to the file so a later upload step can read
+        # it without another extraction; cleaned up together with the video.
+        "writeinfojson": True,
+        "clean_infojson": True,
     })
+    with _info_cache_lock:
+        cached_info = _info_cache.get(url)
     with yt_dlp.YoutubeDL(opts) as ydl:
-        result = ydl.extract_info(url, download=True)
+        if cached_info is not None:
+            # Replay the info dict from the preview extraction instead of
+            # re-fetching metadata from the site.
+            result = ydl.process_ie_result(ydl.sanitize_info(cached_info), download=True)
+        else:
+            result = ydl.extract_info(url, download=True)
         if result.get("_type") == "playlist":
             entries = result.get("entries") or []
             if not entries:
@@ -120,4 +273,5 @@ def download_video_sync(url: str, format_selector: str) -> Tuple[str, str, str]:
 
 
 async def download_video(url: str, format_selector: str) -> Tuple[str, str, str]:
-    return await asyncio.to_thread(download_video_sync, url, format_selector)
\ No newline at end of file
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, download_video_sync, url, format_selector)
\ No newline at end of file
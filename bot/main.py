@@ -1,27 +1,46 @@
+import asyncio
+import functools
 import os
 import re
-import secrets
 import shutil
-from dataclasses import dataclass
-from typing import Dict, List
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
 
+import httpx
 from dotenv import load_dotenv
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import (InlineKeyboardButton, InlineKeyboardMarkup,
+                      MessageEntity, Update)
 from telegram.constants import ChatAction
 from telegram.ext import (Application, CallbackQueryHandler, CommandHandler,
                           ContextTypes, MessageHandler, filters)
 
-from .downloader import VideoInfo, download_video, extract_video_info
+from .downloader import (VideoInfo, download_video, extract_video_info,
+                         label_for_height, lookup_url, selector_for_height)
 
 
 URL_REGEX = re.compile(r"https?://\S+", re.IGNORECASE)
 
+# Shared client so thumbnail fetches reuse connections across requests
+_http_client: Optional[httpx.AsyncClient] = None
 
-@dataclass
-class RequestContext:
-    url: str
-    selectors: List[str]  # index -> selector
-    labels: Dict[str, str]  # selector -> label
+
+def _get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=httpx.Timeout(2.0), follow_redirects=True)
+    return _http_client
+
+
+async def _fetch_thumb(url: str) -> Optional[bytes]:
+    try:
+        resp = await _get_http_client().get(url)
+        resp.raise_for_status()
+        return resp.content
+    except Exception:
+        return None
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -29,12 +48,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "Отправьте ссылку на видео, и я покажу превью и варианты скачивания.")
 
 
-def _ensure_store(context: ContextTypes.DEFAULT_TYPE) -> Dict[str, RequestContext]:
-    if "requests" not in context.application.bot_data:
-        context.application.bot_data["requests"] = {}
-    return context.application.bot_data["requests"]
-
-
 async def _edit_message(query, text: str) -> None:
     msg = query.message
     try:
@@ -48,11 +61,29 @@ async def _edit_message(query, text: str) -> None:
 
 
 async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    text = update.message.text.strip()
-    match = URL_REGEX.search(text)
-    if not match:
-        return
-    url = match.group(0)
+    message = update.message
+    text = (message.text or "").strip()
+
+    # Telegram already detected URL entities server-side; use the first one
+    url = None
+    entities = message.parse_entities(types=[MessageEntity.URL, MessageEntity.TEXT_LINK])
+    for entity, value in entities.items():
+        url = entity.url if entity.type == MessageEntity.TEXT_LINK else value
+        break
+
+    if url is None:
+        # Fallback for messages without entities, with a cheap C-level
+        # prefilter before touching the regex machinery
+        if "://" not in text:
+            return
+        match = URL_REGEX.search(text)
+        if not match:
+            return
+        url = match.group(0)
+
+    # URL entities may lack a scheme (e.g. "youtube.com/...")
+    if "://" not in url:
+        url = "https://" + url
 
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
 
@@ -62,25 +93,26 @@ async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await update.message.reply_text(f"Ошибка: не удалось получить информацию о видео. {e}")
         return
 
-    # Build buttons
-    token = secrets.token_urlsafe(8)
-    store = _ensure_store(context)
-    selectors = [selector for selector, _ in info.format_rows]
-    labels = {selector: label for selector, label in info.format_rows}
-    store[token] = RequestContext(url=url, selectors=selectors, labels=labels)
+    # Start fetching the thumbnail while the keyboard is being built; uploading
+    # the bytes ourselves is faster than making Telegram fetch the CDN URL.
+    thumb_task = None
+    if info.thumbnail_url:
+        thumb_task = asyncio.create_task(_fetch_thumb(info.thumbnail_url))
 
+    # Build buttons. The callback carries the URL hash and the height, so no
+    # per-session state is kept and callbacks survive bot restarts.
     buttons = []
-    for idx, selector in enumerate(selectors):
-        label = labels.get(selector, f"Формат {idx}")
-        # Keep callback data short: dl|token|<index in base36>
-        cb = f"dl|{token}|{idx:x}"
+    for height, label in info.format_rows:
+        cb = f"dl|{info.urlhash}|{height}"
         buttons.append([InlineKeyboardButton(text=label, callback_data=cb)])
 
     keyboard = InlineKeyboardMarkup(buttons)
 
     caption = info.title
-    if info.thumbnail_url:
-        await update.message.reply_photo(photo=info.thumbnail_url, caption=caption, reply_markup=keyboard)
+    if thumb_task is not None:
+        # Fall back to the URL if the prefetch failed or timed out
+        thumb = await thumb_task
+        await update.message.reply_photo(photo=thumb or info.thumbnail_url, caption=caption, reply_markup=keyboard)
     else:
         await update.message.reply_text(text=caption, reply_markup=keyboard)
 
@@ -93,25 +125,24 @@ async def on_download_click(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not data.startswith("dl|"):
         return
     try:
-        _, token, idx_hex = data.split("|", 2)
-        idx = int(idx_hex, 16)
+        _, urlhash, height_str = data.split("|", 2)
+        height = int(height_str)
     except Exception:
         return
 
-    store = _ensure_store(context)
-    req = store.get(token)
-    if not req or not (0 <= idx < len(req.selectors)):
+    url = await asyncio.get_running_loop().run_in_executor(None, lookup_url, urlhash)
+    if not url:
         await _edit_message(query, "Сессия устарела. Отправьте ссылку снова.")
         return
 
-    selector = req.selectors[idx]
-    label = req.labels.get(selector, "запрошенный формат")
+    selector = selector_for_height(height)
+    label = label_for_height(height)
 
     await _edit_message(query, f"Скачивание {label}…")
 
     try:
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.UPLOAD_VIDEO)
-        filepath, filename, ext = await download_video(req.url, selector)
+        filepath, filename, ext = await download_video(url, selector)
     except Exception as e:
         await _edit_message(query, f"Не удалось скачать {label}: {e}")
         return
@@ -132,36 +163,85 @@ async def on_download_click(update: Update, context: ContextTypes.DEFAULT_TYPE)
             ),
         )
         # Cleanup large file without uploading
-        try:
-            os.remove(filepath)
-        except OSError:
-            pass
-        try:
-            shutil.rmtree(os.path.dirname(filepath), ignore_errors=True)
-        except Exception:
-            pass
+        _cleanup_queue.put_nowait(os.path.dirname(filepath))
         return
 
-    # Upload video/document
+    # Upload video/document. Pass the path so PTB's async HTTP client streams
+    # the file itself instead of us blocking the event loop on open/read.
     try:
         if ext.lower() in {"mp4", "mov", "m4v"}:
-            with open(filepath, "rb") as f:
-                await query.message.reply_video(video=f, caption=filename)
+            # supports_streaming lets clients scrub before the upload finishes
+            await query.message.reply_video(
+                video=Path(filepath), caption=filename, supports_streaming=True,
+                read_timeout=120, write_timeout=300)
         else:
-            with open(filepath, "rb") as f:
-                await query.message.reply_document(document=f, caption=filename)
+            await query.message.reply_document(
+                document=Path(filepath), caption=filename,
+                read_timeout=120, write_timeout=300)
     finally:
-        # Cleanup temp files
+        # Queue the whole temp dir (video + .info.json sidecar) for background
+        # deletion instead of rmtree-ing inline
+        _cleanup_queue.put_nowait(os.path.dirname(filepath))
+
+    await _edit_message(query, f"Готово: {label}")
+
+
+# Temp dirs queued here are deleted by a background worker so rmtree's
+# recursive walk never blocks a reply.
+_cleanup_queue: "asyncio.Queue[str]" = asyncio.Queue()
+# Module-level reference so the infinite worker task is owned and can be
+# cancelled at shutdown
+_cleanup_task: Optional["asyncio.Task[None]"] = None
+
+
+async def _cleanup_worker() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        path = await _cleanup_queue.get()
         try:
-            os.remove(filepath)
-        except OSError:
-            pass
+            await loop.run_in_executor(
+                None, functools.partial(shutil.rmtree, path, ignore_errors=True))
+        finally:
+            _cleanup_queue.task_done()
+
+
+def _sweep_temp_dirs(max_age: float = 3600) -> None:
+    # Downloads normally clean up after themselves, but a crash or SIGKILL
+    # before the finally block leaves vd_* dirs behind.
+    now = time.time()
+    try:
+        entries = list(os.scandir(tempfile.gettempdir()))
+    except OSError:
+        return
+    for entry in entries:
         try:
-            shutil.rmtree(os.path.dirname(filepath), ignore_errors=True)
-        except Exception:
-            pass
+            if entry.name.startswith("vd_") and entry.is_dir() and now - entry.stat().st_mtime > max_age:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            continue
 
-    await _edit_message(query, f"Готово: {label}")
+
+async def cleanup_temp(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await asyncio.get_running_loop().run_in_executor(None, _sweep_temp_dirs)
+
+
+async def _on_startup(app: Application) -> None:
+    # Bound yt-dlp concurrency with a shared pool of warm threads instead of
+    # spawning an unbounded thread per request via asyncio.to_thread.
+    executor = ThreadPoolExecutor(
+        max_workers=int(os.getenv("YTDL_WORKERS", "8")),
+        thread_name_prefix="ytdl",
+    )
+    asyncio.get_running_loop().set_default_executor(executor)
+    # Plain asyncio task: Application.create_task would warn (and not track
+    # the task) because post_init runs before the application is started
+    global _cleanup_task
+    _cleanup_task = asyncio.create_task(_cleanup_worker())
+
+
+async def _on_shutdown(app: Application) -> None:
+    if _cleanup_task is not None:
+        _cleanup_task.cancel()
 
 
 def main() -> None:
@@ -170,14 +250,41 @@ def main() -> None:
     if not token:
         raise RuntimeError("BOT_TOKEN не задан. Укажите его в .env")
 
-    app = Application.builder().token(token).build()
+    app = (
+        Application.builder()
+        .token(token)
+        # Generous timeouts so large uploads don't time out mid-transfer
+        .read_timeout(60)
+        .write_timeout(300)
+        .post_init(_on_startup)
+        .post_shutdown(_on_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND) & filters.Regex(URL_REGEX), handle_url))
+    app.add_handler(MessageHandler(
+        filters.TEXT & (~filters.COMMAND)
+        & (filters.Entity(MessageEntity.URL) | filters.Entity(MessageEntity.TEXT_LINK)),
+        handle_url))
     app.add_handler(CallbackQueryHandler(on_download_click, pattern=r"^dl\|"))
 
+    app.job_queue.run_repeating(cleanup_temp, interval=900, first=60)
+
     print("Bot is running… Press Ctrl+C to stop.")
-    app.run_polling(close_loop=False)
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        # Push-based delivery: near-zero idle CPU and no long-poll latency
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", "8080")),
+            url_path=token,
+            webhook_url=f"{webhook_url.rstrip('/')}/{token}",
+            secret_token=os.getenv("WEBHOOK_SECRET"),
+            close_loop=False,
+        )
+    else:
+        # Polling keeps local development setup-free
+        app.run_polling(close_loop=False)
 
 
 if __name__ == "__main__":